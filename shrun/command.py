@@ -10,8 +10,8 @@ import termcolor
 class SharedContext(object):
     def __init__(self):
         self._name_result = {}
+        self._name_done = {}
         self._predicates = {}
-        self._done_event = threading.Condition()
 
     def register_name(self, name):
         if not name:
@@ -19,6 +19,7 @@ class SharedContext(object):
 
         assert name not in self._name_result, "name '{}' is already in use".format(name)
         self._name_result[name] = None
+        self._name_done[name] = threading.Event()
 
     def wait_for_dependencies(self, depends_on):
         """ Wait for dependencies to pass
@@ -30,16 +31,14 @@ class SharedContext(object):
             True when all have passed, False if any have failed
         """
 
-        while any(self._name_result[d] is None for d in depends_on):
-            with self._done_event:
-                self._done_event.wait()
+        for d in depends_on:
+            self._name_done[d].wait()
         return [d for d in depends_on if not self._name_result[d]]
 
     def mark_as_done(self, name, success):
         if name:
             self._name_result[name] = success
-            with self._done_event:
-                self._done_event.notify_all()
+            self._name_done[name].set()
 
     def set_predicates(self, passed, predicates):
         for pred in predicates:
@@ -55,9 +54,14 @@ class SharedContext(object):
 
 
 class Job(object):
+    TAG_KEYS = ('depends_on', 'if', 'unless', 'set')
+
     def __init__(self, command):
         self._command = command
         self._prepared = False
+        # Parsed once since they are checked again while waiting on dependencies
+        self._tags = {key: tuple(self.extract_tags(command.features.get(key, [])))
+                      for key in self.TAG_KEYS}
 
     @property
     def name(self):
@@ -72,7 +76,7 @@ class Job(object):
         return self._command
 
     def tags(self, key):
-        return self.extract_tags(self.command.features.get(key, []))
+        return self._tags[key]
 
     @staticmethod
     def extract_tags(tags):
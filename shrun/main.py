@@ -8,7 +8,9 @@ from __future__ import print_function
 
 import argparse
 import functools
+import hashlib
 import os
+import pickle
 import shutil
 import signal
 import sys
@@ -22,6 +24,85 @@ import yaml
 from . import runner
 from . import version
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:  # libyaml isn't available
+    from yaml import SafeLoader as _Loader
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'shrun-cache-{}'.format(os.getuid()))
+CONTENT_VERSION_HEADER = '# content-version:'
+
+
+def _cache_key(path, f):
+    """ Key an open file on its content-version header if it has one, else on its mtime and size
+
+    The file is stat'ed through its descriptor so the key always describes the contents that get
+    parsed, even if the file is replaced in the meantime.
+    """
+    first_line = f.readline()
+    f.seek(0)
+
+    if first_line.startswith(CONTENT_VERSION_HEADER):
+        version_key = first_line[len(CONTENT_VERSION_HEADER):].strip()
+    else:
+        stat = os.fstat(f.fileno())
+        mtime = getattr(stat, 'st_mtime_ns', None) or repr(stat.st_mtime)  # Python 2 has no ns
+        version_key = '{}:{}'.format(mtime, stat.st_size)
+
+    key = '{}:{}:{}'.format(sys.version_info[0], os.path.realpath(path), version_key)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _cache_dir():
+    """ Returns the cache directory, or None if it can't be safely used """
+    try:
+        os.mkdir(CACHE_DIR, 0o700)
+    except OSError:
+        pass
+
+    try:
+        stat = os.stat(CACHE_DIR)
+    except OSError:
+        return None
+    # Unpickling runs arbitrary code so only trust a cache that nobody else can write to
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        return None
+    return CACHE_DIR
+
+
+def load_yaml(path, use_cache=True):
+    """ Parse a yaml file, reusing the result of a previous parse if the file hasn't changed """
+    cache_dir = _cache_dir() if use_cache else None
+
+    with open(path, 'r') as f:
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, _cache_key(path, f))
+            try:
+                with open(cache_path, 'rb') as cache_file:
+                    return pickle.load(cache_file)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+
+        data = yaml.load(f, Loader=_Loader)
+
+    if cache_dir:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump(data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)  # Atomic so concurrent runs never see partial files
+        except (IOError, OSError):
+            pass
+
+    return data
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("'{}' is not a positive integer".format(value))
+    return number
+
 
 def main(argv=sys.argv):
     parser = argparse.ArgumentParser(description="{} script runnner".format(__name__),
@@ -33,6 +114,11 @@ def main(argv=sys.argv):
     parser.add_argument('--retry_interval', default=1, type=int, help="Seconds between retries.")
     parser.add_argument('--output-timeout', default=300, type=int, dest='output_timeout',
                         help="Timeout for any background job not generating output.")
+    parser.add_argument('--workers', default=runner.DEFAULT_WORKERS, type=positive_int,
+                        help="Maximum number of commands to run at once, not counting background "
+                             "commands and commands with dependencies.")
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        help="Always parse the file instead of reusing a cached parse.")
     parser.add_argument('file', nargs='?',
                         help="File to run")
 
@@ -41,8 +127,7 @@ def main(argv=sys.argv):
         print(version.VERSION)
         exit(0)
 
-    with open(args.file, 'r') as f:
-        data = yaml.load(f.read())
+    data = load_yaml(args.file, use_cache=args.cache)
 
     if isinstance(data, dict):
         environment = data.get('environment', {})
@@ -70,7 +155,7 @@ def main(argv=sys.argv):
 
     run = functools.partial(
         runner.run_commands, shell=args.shell, retry_interval=args.retry_interval, tmpdir=tmpdir,
-        environment=environment, output_timeout=args.output_timeout)
+        environment=environment, output_timeout=args.output_timeout, workers=args.workers)
 
     try:
         if args.timeout is not None:
@@ -1,12 +1,17 @@
+from __future__ import print_function
 from builtins import str
 
 import collections
+import concurrent.futures
 import contextlib
+import errno
+import fcntl
 import functools
 import itertools
 import io
 import os
 import re
+import select
 import six
 import subprocess
 import threading
@@ -24,6 +29,15 @@ COLORS = ['yellow', 'blue', 'red', 'green', 'magenta', 'cyan']
 IO_ERROR_RETRY_INTERVAL = 0.1
 IO_ERROR_RETRY_ATTEMPTS = 100
 
+DEFAULT_WORKERS = 32
+
+NAME_RE = re.compile(r'\w+')
+
+READ_SIZE = 65536
+# Longest wait for output before checking whether a command has exited; only matters when
+# something the command started in the background keeps its output open after it exits
+EXIT_POLL_INTERVAL = 0.5
+
 RunnerResults = collections.namedtuple('RunnerResults', ('failed', 'running', 'interrupt'))
 
 
@@ -41,22 +55,60 @@ def print_exceptions(f):
     return wrapper
 
 
-# See https://bugs.python.org/issue1167930 for why thread join ignores interrupts
-class InterruptibleThread(threading.Thread):
-    POLL_FREQ = 0.1
+# See https://bugs.python.org/issue1167930 for why waiting without a timeout ignores interrupts
+def wait_interruptibly(futures, poll_freq=0.1):
+    """ Wait for all the futures to complete """
+    while concurrent.futures.wait(futures, timeout=poll_freq).not_done:
+        pass
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def read_available(fd):
+    """ Read everything that can be read from a non-blocking file descriptor without waiting
+
+    Returns:
+        A tuple: (The data read, True if the end of the file was reached)
+    """
+    chunks = []
+    while True:
+        try:
+            chunk = os.read(fd, READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return b''.join(chunks), False
+            raise
+        if not chunk:
+            return b''.join(chunks), True
+        chunks.append(chunk)
 
-    def join(self, timeout=None):
-        start_time = time.time()
-        while not timeout or time.time() - start_time < timeout:
-            super(InterruptibleThread, self).join(timeout or self.POLL_FREQ)
-            if not self.is_alive():
-                return
-        return
+
+def run_in_thread(fn, **kwargs):
+    """ Run a function in its own daemon thread
+
+    Returns:
+        A future for the result of the function
+    """
+    future = concurrent.futures.Future()
+
+    def target():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(**kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True  # Ensure this thread doesn't outlive the main thread
+    thread.start()
+    return future
 
 
 class Runner(object):
     def __init__(self, tmpdir, environment, retry_interval=None, shell='/bin/bash',
-                 output_timeout=None):
+                 output_timeout=None, workers=DEFAULT_WORKERS):
         self.tmpdir = tmpdir
         self._retry_interval = retry_interval
         self._shell = shell
@@ -69,33 +121,41 @@ class Runner(object):
         self._environment = environment
         self._name_counts = {}
         self._dead = False
-        self.threads_lock = threading.Lock()
-        self.threads = collections.defaultdict(list)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.futures_lock = threading.Lock()
+        self.futures = collections.defaultdict(list)
         self._results = {}
 
     def kill_all(self):
-        """ Kills all running threads """
+        """ Kills all running jobs """
         self._dead = True
-        while True:  # Keep killing procs until the threads terminate
-            with self.threads_lock:
-                if any(t.isAlive() for t in itertools.chain(*self.threads.values())):
+        with self.futures_lock:
+            for future in itertools.chain(*self.futures.values()):
+                future.cancel()  # Jobs that haven't started yet never will
+        while True:  # Keep killing procs until the jobs terminate
+            with self.futures_lock:
+                if any(not f.done() for f in itertools.chain(*self.futures.values())):
                     with self._procs_lock:
                         for proc in self._procs:
                             proc.kill()
                     time.sleep(0.1)
                 else:
+                    self._executor.shutdown(wait=False)
                     return True
 
     @staticmethod
     def print_lines(lines, prefix, color, end=''):
-        for line in lines:
-            for _ in range(IO_ERROR_RETRY_ATTEMPTS):
-                try:
-                    termcolor.cprint(prefix + str(line), color, end=end)
-                except IOError:
-                    time.sleep(IO_ERROR_RETRY_INTERVAL)
-                else:
-                    break
+        # Color each line separately so colors in the output can't leak into the next prefix
+        text = ''.join(termcolor.colored(prefix + str(line), color) + end for line in lines)
+        if not text:
+            return
+        for _ in range(IO_ERROR_RETRY_ATTEMPTS):
+            try:
+                print(text, end='')
+            except IOError:
+                time.sleep(IO_ERROR_RETRY_INTERVAL)
+            else:
+                break
 
     @property
     def env(self):
@@ -136,7 +196,7 @@ class Runner(object):
         if name:
             command_name = name
         else:
-            command_name = re.search('\w+', command).group(0)
+            command_name = NAME_RE.search(command).group(0)
             if command_name in self._name_counts:
                 self._name_counts[command_name] += 1
                 command_name = '{}_{}'.format(command_name, self._name_counts[command_name])
@@ -159,14 +219,23 @@ class Runner(object):
             stdout_path = os.path.join(self.tmpdir, '{}_{}.stdout'.format(command_name, attempt))
             stderr_path = os.path.join(self.tmpdir, '{}_{}.stderr'.format(command_name, attempt))
 
-            with io.open(stdout_path, 'wb') as stdout_writer, \
-                    io.open(stdout_path, 'rb') as stdout_reader, \
-                    io.open(stderr_path, 'wb') as stderr_writer, \
-                    io.open(stderr_path, 'rb') as stderr_reader:
+            stdout_read, stdout_write = os.pipe()
+            stderr_read, stderr_write = os.pipe()
+
+            with io.open(stdout_path, 'wb') as stdout_log, \
+                    io.open(stderr_path, 'wb') as stderr_log, \
+                    io.open(stdout_read, 'rb', buffering=0) as stdout_reader, \
+                    io.open(stderr_read, 'rb', buffering=0) as stderr_reader:
 
                 # See http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true  # noqa
-                proc = subprocess.Popen(command.command, shell=True, executable=self._shell,
-                                        stdout=stdout_writer, stderr=stderr_writer, env=self.env)
+                try:
+                    proc = subprocess.Popen(command.command, shell=True, executable=self._shell,
+                                            stdout=stdout_write, stderr=stderr_write,
+                                            env=self.env, close_fds=True)
+                finally:
+                    # Only the command writes to the pipes so we see the end once it exits
+                    os.close(stdout_write)
+                    os.close(stderr_write)
 
                 with self._procs_lock:
                     self._procs.append(proc)
@@ -177,30 +246,56 @@ class Runner(object):
                     message=('Retrying ({})'.format(attempt) if attempt > 0 else 'Running'),
                     prefix=prefix, color=color)
 
+                streams = {stdout_reader.fileno(): (stdout_log, '{}| '.format(prefix)),
+                           stderr_reader.fileno(): (stderr_log, '{}: '.format(prefix))}
+                for fd in streams:
+                    set_nonblocking(fd)
+                open_fds = set(streams)
+
+                def print_output(fds):
+                    """ Print and log what's available on the descriptors. Returns True if any. """
+                    saw_output = False
+                    for fd in fds:
+                        data, eof = read_available(fd)
+                        if eof:
+                            open_fds.discard(fd)
+                        if data:
+                            saw_output = True
+                            log, line_prefix = streams[fd]
+                            log.write(data)
+                            with self._output_lock:
+                                self.print_lines(
+                                    data.decode('utf-8', 'replace').splitlines(True),
+                                    line_prefix, color)
+                    return saw_output
+
                 last_output_time = time.time()
+                timed_out = False
+                check_timeout = timeout is not None and not background
+
+                while open_fds:
+                    wait = EXIT_POLL_INTERVAL
+                    if check_timeout and not timed_out:
+                        wait = max(0, min(wait, last_output_time + timeout - time.time()))
 
-                def print_output():
-                    with self._output_lock:
-                        out = stdout_reader.readlines()
-                        err = stderr_reader.readlines()
-                        self.print_lines(out, '{}| '.format(prefix), color)
-                        self.print_lines(err, '{}: '.format(prefix), color)
-                        return bool(out or err)
+                    ready, _, _ = select.select(list(open_fds), [], [], wait)
+                    saw_output = print_output(ready)
 
-                while proc.poll() is None:
-                    saw_output = print_output()
                     current_time = time.time()
-                    if (timeout is not None and current_time > last_output_time + timeout and
-                            not background):
+                    if saw_output:
+                        last_output_time = current_time
+                    elif (check_timeout and not timed_out and
+                            current_time >= last_output_time + timeout):
+                        timed_out = True
                         proc.kill()
                         termcolor.cprint('{}! OUTPUT TIMEOUT ({:0.1f}s)'.format(prefix, timeout),
                                          color, attrs=['bold'])
-                    elif saw_output:
-                        last_output_time = current_time
 
-                    time.sleep(0.05)
+                    if proc.poll() is not None:
+                        print_output(list(open_fds))  # Everything it wrote is already in the pipes
+                        break
 
-                print_output()
+                proc.wait()
 
                 with self._procs_lock:
                     self._procs.remove(proc)
@@ -251,35 +346,38 @@ class Runner(object):
         job = command.Job(command=cmd)
         job.synchronous_prepare(shared_context)
 
-        thread = InterruptibleThread(
-            target=self._run_job,
-            kwargs=dict(runner=self,
-                        job=job,
-                        job_id=job_id,
-                        shared_context=shared_context))
-        thread.daemon = True  # Ensure this thread doesn't outlive the main thread
+        kwargs = dict(runner=self, job=job, job_id=job_id, shared_context=shared_context)
+        if job.background or job.tags('depends_on'):
+            # These can block indefinitely so they'd starve the pool of workers
+            future = run_in_thread(self._run_job, **kwargs)
+        else:
+            future = self._executor.submit(self._run_job, **kwargs)
+        future.add_done_callback(
+            functools.partial(self._forget_if_cancelled, job_id, job, shared_context))
 
-        # Keep track of all running threads
-        with self.threads_lock:
+        # Keep track of all submitted jobs
+        with self.futures_lock:
             if job.background:
-                self.threads['background'].append(thread)
+                self.futures['background'].append(future)
             else:
-                self.threads['normal'].append(thread)
-
-        thread.start()
+                self.futures['normal'].append(future)
 
         # Wait if command is synchronous
         if not (job.background or job.name):
-            thread.join()
+            wait_interruptibly([future])
 
         return self._results.get(job_id)
 
+    def _forget_if_cancelled(self, job_id, job, shared_context, future):
+        if future.cancelled():
+            self._results.pop(job_id, None)  # The job never started so it isn't running or failed
+            shared_context.mark_as_done(job.name, False)  # Don't leave dependent jobs waiting
+
     def finish(self):
         """ Waits for non-background jobs. """
 
-        # Wait for all the non-background threads to complete
-        for t in self.threads['normal']:
-            t.join()
+        # Wait for all the non-background jobs to complete
+        wait_interruptibly(self.futures['normal'])
 
     def failures(self):
         """ Returns failed jobs """
@@ -293,7 +391,7 @@ class Runner(object):
 
 
 def run_commands(commands, retry_interval=None, shell='/bin/bash', tmpdir=None, output_timeout=None,
-                 environment={}):
+                 environment={}, workers=DEFAULT_WORKERS):
     """
 
     Args:
@@ -303,6 +401,8 @@ def run_commands(commands, retry_interval=None, shell='/bin/bash', tmpdir=None,
         tmpdir: temporary directory to store output logs
         output_timeout: Fail command if it takes longer than this number of seconds
         environment: Environment variables to use during command run
+        workers: Maximum number of commands to run at once, not counting background commands
+            and commands with dependencies since those can block indefinitely
 
     Returns:
         RunnerResults (a tuple):
@@ -315,7 +415,7 @@ def run_commands(commands, retry_interval=None, shell='/bin/bash', tmpdir=None,
         "Expected command list to be a list but got {}".format(type(commands)))
 
     job_runner = Runner(tmpdir=tmpdir, retry_interval=retry_interval, shell=shell,
-                        environment=environment, output_timeout=output_timeout)
+                        environment=environment, output_timeout=output_timeout, workers=workers)
 
     shared_context = command.SharedContext()
 
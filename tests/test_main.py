@@ -18,6 +18,14 @@ def tmpdir_as_cwd(tmpdir):
         yield
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    """ Keep cached parses out of the real temp directory """
+    path = str(tmpdir.join('cache'))
+    monkeypatch.setattr(main, 'CACHE_DIR', path)
+    return path
+
+
 def run_command(command, args=()):
     with open('test.yml', 'w') as f:
         f.write(command)
@@ -187,3 +195,62 @@ def test_exception_during_cleanup(capfd):
         for path in delete_paths:
             os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IEXEC)
             shutil.rmtree(path)
+
+
+def test_unchanged_file_is_not_parsed_again(capfd):
+    """ The parsed contents of an unchanged file are reused """
+    run_command('- echo Hello')
+    with mock.patch.object(main.yaml, 'load', side_effect=AssertionError("Parsed again")):
+        main.main(('this-command', 'test.yml'))
+    out, err = capfd.readouterr()
+    assert out.count('Done') == 2
+
+
+def test_touched_file_is_parsed_again(capfd):
+    """ A cached parse isn't used once the file's mtime changes """
+    run_command('- echo Hello')
+    os.utime('test.yml', (0, 0))
+    run_command('- echo Hallo')  # Same size, so only the mtime differs
+    out, err = capfd.readouterr()
+    assert 'Hallo' in out
+
+
+def test_content_version_header_is_used_as_key(capfd):
+    """ Files with a content-version header are reused while the version is unchanged """
+    run_command('# content-version: 1\n- echo Hello')
+    os.utime('test.yml', (0, 0))
+    with mock.patch.object(main.yaml, 'load', side_effect=AssertionError("Parsed again")):
+        main.main(('this-command', 'test.yml'))
+    run_command('# content-version: 2\n- echo Hallo')
+    out, err = capfd.readouterr()
+    assert out.count('Hello') == 4  # Running and output lines for both runs
+    assert 'Hallo' in out
+
+
+def test_no_cache(capfd):
+    """ --no-cache always parses the file """
+    run_command('- echo Hello')
+    with mock.patch.object(main.yaml, 'load', side_effect=AssertionError("Parsed again")):
+        with pytest.raises(AssertionError):
+            main.main(('this-command', '--no-cache', 'test.yml'))
+
+
+def test_workers(capfd):
+    """ The number of workers can be limited """
+    run_command("""
+        - sleep 1000:
+            background: true
+        - echo one
+        - echo two
+        """, ('--workers', '1'))
+    out, err = capfd.readouterr()
+    assert 'one' in out
+    assert 'two' in out
+
+
+@pytest.mark.parametrize('workers', ['0', '-1', 'many'])
+def test_invalid_workers(capfd, workers):
+    """ The number of workers must be a positive integer """
+    with pytest.raises(SystemExit) as exc_info:
+        run_command('- echo Hello', ('--workers', workers))
+    assert exc_info.value.code == 2
@@ -3,12 +3,14 @@ from __future__ import print_function
 import mock
 import os
 import tempfile
+import time
 
 import pytest  # flake8: noqa
 
-import termcolor
 import yaml
 
+from shrun import command
+from shrun import parser
 from shrun import runner
 
 
@@ -246,20 +248,114 @@ def test_foreach(capfd):
 
 def test_error_during_print(capfd):
     """ Foreach are indicated when the first entry of a sequence has key 'foreach' """
-    original_cprint = termcolor.cprint
     calls = []
 
     # Generate failures for the first 50 attempts
-    def bad_cprint(*args, **kwargs):
+    def bad_print(*args, **kwargs):
         calls.append(1)
         if len(calls) < 50:
             raise IOError
-        original_cprint(*args, **kwargs)
+        print(*args, **kwargs)
 
-    with mock.patch.object(termcolor, 'cprint', bad_cprint):
+    with mock.patch.object(runner, 'print', bad_print, create=True):
         with mock.patch.object(runner, 'IO_ERROR_RETRY_INTERVAL', 0):  # Speed up test
             run_command("- echo hello{{1}}")
 
     assert len(calls) >= 50
     out, err = capfd.readouterr()
     assert "hello1" in out
+
+
+def test_background_jobs_dont_use_up_workers(capfd):
+    """ Background jobs run outside the worker pool so they can't starve later commands """
+    results = runner.run_commands(yaml.load("""
+        - sleep 1000:
+            background: true
+        - sleep 1001:
+            background: true
+        - echo reached
+        """), tmpdir=tempfile.gettempdir(), environment={}, workers=2)
+    assert not results.failed
+    out, err = capfd.readouterr()
+    assert 'reached' in out
+
+
+def test_dependent_jobs_dont_use_up_workers(capfd):
+    """ Jobs waiting on dependencies run outside the worker pool """
+    results = runner.run_commands(yaml.load("""
+        - sleep 0.5:
+            name: first
+            background: true
+        - echo second:
+            depends_on: first
+            name: second
+        - echo third:
+            depends_on: first
+            name: third
+        - echo fourth
+        """), tmpdir=tempfile.gettempdir(), environment={}, workers=1)
+    assert not results.failed
+    out, err = capfd.readouterr()
+    assert out.index('fourth') < out.index('second')
+    assert 'third' in out
+
+
+def test_jobs_cancelled_before_starting_arent_running():
+    """ Jobs still queued for a worker when everything is killed are not reported as running """
+    job_runner = runner.Runner(tmpdir=tempfile.gettempdir(), environment={}, workers=1)
+    shared_context = command.SharedContext()
+    for job_id, cmd in enumerate(parser.generate_commands(yaml.load("""
+            - sleep 1000:
+                name: sleeping
+            - echo queued:
+                name: queued
+            """))):
+        job_runner.start(cmd, job_id=job_id, shared_context=shared_context)
+    while not job_runner.futures['normal'][0].running():
+        time.sleep(0.01)
+    job_runner.kill_all()
+    assert job_runner.running() == []
+    assert job_runner.failures() == [0]
+
+
+def test_jobs_depending_on_cancelled_jobs_dont_start(capfd):
+    """ Jobs waiting on a job that was cancelled before it started are not left waiting """
+    job_runner = runner.Runner(tmpdir=tempfile.gettempdir(), environment={}, workers=1)
+    shared_context = command.SharedContext()
+    for job_id, cmd in enumerate(parser.generate_commands(yaml.load("""
+            - sleep 1000:
+                name: sleeping
+            - echo queued:
+                name: queued
+            - echo dependent:
+                depends_on: queued
+            """))):
+        job_runner.start(cmd, job_id=job_id, shared_context=shared_context)
+    while not job_runner.futures['normal'][0].running():
+        time.sleep(0.01)
+    job_runner.kill_all()
+    assert job_runner.running() == []
+    assert job_runner.failures() == [0, 2]
+    out, err = capfd.readouterr()
+    assert "NOT STARTED: The following dependencies failed: 'queued'" in err
+
+
+def test_command_leaving_process_in_background_finishes(capfd):
+    """ A process started in the background by a command doesn't keep the command running """
+    start_time = time.time()
+    results = run_command("- sleep 30 & echo Started")
+    assert not results.failed
+    assert time.time() - start_time < 10
+    out, err = capfd.readouterr()
+    assert 'Started' in out
+    assert 'Done' in out
+
+
+def test_output_is_logged(capfd, tmpdir):
+    """ Output is written to log files in the temporary directory """
+    runner.run_commands(yaml.load("""
+        - echo out && echo err >&2:
+            name: logged
+        """), tmpdir=str(tmpdir), environment={})
+    assert tmpdir.join('logged_0.stdout').read() == 'out\n'
+    assert tmpdir.join('logged_0.stderr').read() == 'err\n'